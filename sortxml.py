@@ -46,96 +46,147 @@ __description__ = """
 """
 
 import argparse as ap
+import re
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from io import TextIOWrapper
+from io import TextIOWrapper, StringIO
 from codecs import BOM_UTF8
+from copy import deepcopy
+from datetime import datetime
 from decimal import Decimal
+from functools import lru_cache
+from hashlib import blake2b
 from dateutil.parser import parse as parse_dt
 
+try:
+    from lxml import etree
+except ImportError:
+    # lxml is optional, we'll fall back to the standard library's ElementTree
+    etree = None
 
-class NSElement(ET.Element):
-    """Subclass of ElementTree.Element which keeps track of its TreeBuilder and namespaces if available."""
-    
-    def __init__(self, *args, **kwargs):
-        self._ns_map = dict()
-        self._builder = None
-        if 'builder' in kwargs:
-            builder = kwargs.pop('builder')
-            self._builder = builder
-            if hasattr(builder, 'ns_map'):
-                self._ns_map = builder.ns_map
-        super().__init__(*args, **kwargs)
-        
-    def find(self, path, namespaces=None):
-        if namespaces is None:
-            namespaces = self._ns_map
-        return super().find(path, namespaces)
-
-    def findall(self, path, namespaces=None):
-        if namespaces is None:
-            namespaces = self._ns_map
-        return super().findall(path, namespaces)
-        
-    def findtext(self, path, default=None, namespaces=None):
-        if namespaces is None:
-            namespaces = self._ns_map
-        return super().findtext(path, default, namespaces)
-        
-    def iterfind(self, path, namespaces=None):
-        if namespaces is None:
-            namespaces = self._ns_map
-        return super().iterfind(path, namespaces)
 
+# a letter or underscore followed by any letters, digits, or underscores
+_NAME_RE = re.compile(r'[^\W\d]\w*\Z')
 
-class NSTreeBuilder(ET.TreeBuilder):
-    """Subclass of ElementTree.TreeBuilder which adds namespaces in the document to the namespace registry."""
-    
-    def __init__(self, **kwargs):
-        self.ns_map = dict()
-        if 'element_factory' in kwargs:
-            del kwargs['element_factory']
-        super().__init__(element_factory=NSElement, **kwargs)
-    
-    def start_ns(self, prefix, uri):
-        self.ns_map[prefix] = uri
-        ET.register_namespace(prefix, uri)
-        
-    def start(self, tag, attrs):
-        if self._factory is NSElement:
-            self._flush()
-            self._last = e = self._factory(tag, attrs, builder=self)
-            if self._elem:
-                self._elem[-1].append(e)
-            elif self._root is None:
-                self._root = e
-            self._elem.append(e)
-            self._tail = 0
-            return e
-        else:
-            return super().start(tag, attrs)
-        
-    def _handle_single(self, factory, insert, *args):
-        if factory is NSElement:
-            e = factory(*args, builder=self)
-            if insert:
-                self._flush()
-                self._last = e
-                if self._elem:
-                    self._elem[-1].append(e)
-                self._tail = 1
-            return e
+
+@lru_cache(maxsize=128)
+def _compiled_xpath(path):
+    """Compile an lxml XPath expression using {namespace}tag notation, caching it for reuse."""
+    return etree.ETXPath(path)
+
+
+def _parse_datetime(s):
+    """Parse a date/time string, trying the fast ISO 8601 parser before falling back to `dateutil`."""
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        return parse_dt(s)
+
+
+def _argsort_decimal(values, descending=False):
+    """Use NumPy to find the stable sort order for a list of decimal strings.  Returns None if they can't all be
+    parsed as floats or if floats can't be trusted to order them the same way Decimal would."""
+    import numpy as np  # already imported by sort_xml() if we got here
+    try:
+        keys = np.fromiter(map(float, values), dtype=np.float64, count=len(values))
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(keys).any():
+        return None
+    if descending:
+        keys = -keys  # rather than reversing the order, so equal keys keep their original order
+    order = np.argsort(keys, kind='stable')
+
+    # different decimals can round to the same float, so only trust ties between identical strings
+    sorted_keys = keys[order]
+    ties = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1])
+    if ties.size:
+        values = np.array(values, dtype=object)
+        if (values[order[ties]] != values[order[ties + 1]]).any():
+            return None
+    return order.tolist()
+
+
+def _parse_xml(xml_file, xml_str):
+    """Parse an XML document from a filename or a string.  Returns the root element and a map of all the namespace
+    prefixes declared in the document."""
+    # let the parser's stock (C) treebuilder make the tree and only ask it to report namespace declarations, so
+    # there's no Python code running per element
+    ns_map = dict()
+    if etree is not None:
+        # drop comments and processing instructions like ElementTree does, otherwise lxml keeps them as children
+        # that have no attributes or text to sort by.  Like expat, lxml 5+ only expands internal entities by default
+        # (resolve_entities='internal'), so external ones can't pull local files into the output.
+        options = dict(huge_tree=True, collect_ids=False, remove_comments=True, remove_pis=True)
+        # (lxml's find methods use None rather than '' for the default namespace)
+        if xml_file is not None:
+            # iterparse has libxml2 read the file itself
+            context = etree.iterparse(xml_file, events=('start-ns',), **options)
+            for _, (prefix, uri) in context:
+                ns_map[prefix or None] = uri
+            dom = context.root
         else:
-            return super()._handle_single(factory, insert, *args)
+            parser = etree.XMLPullParser(events=('start-ns',), **options)
+            parser.feed(xml_str)
+            for _, (prefix, uri) in parser.read_events():
+                ns_map[prefix or None] = uri
+            dom = parser.close()
+    else:
+        context = ET.iterparse(xml_file if xml_file is not None else StringIO(xml_str), events=('start-ns',))
+        for _, (prefix, uri) in context:
+            ns_map[prefix] = uri
+        dom = context.root
+    return dom, ns_map
+
+
+def _copy_root(dom):
+    """Deep copy a parsed document's root element."""
+    if etree is not None:
+        # copy the whole document, or lxml drops anything outside the root element such as the doctype
+        return deepcopy(dom.getroottree()).getroot()
+    return deepcopy(dom)
+
+
+def _parse_xml_cached(xml_file, xml_str, cache):
+    """Parse an XML document like `_parse_xml`, but keep a pristine copy of it in `cache` (a dict) so sorting the
+    same document again with the same cache (e.g. under a different path) doesn't have to parse it again.  Always
+    returns a tree that the caller is free to modify."""
+    # key on a digest of the contents rather than a file's name and timestamps, so a rewritten file is never missed
+    digest = blake2b(digest_size=16)
+    if xml_file is not None:
+        with open(xml_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        key = ('file', digest.digest())
+    else:
+        digest.update(xml_str.encode('utf-8'))
+        key = ('str', digest.digest())
+
+    cached = cache.get(key)
+    if cached is None:
+        cached = cache[key] = _parse_xml(xml_file, xml_str)
+    dom, ns_map = cached
+    return _copy_root(dom), ns_map
+
+
+def _reorder(par, children, sorted_children):
+    """Replace the children of `par` (currently `children`) with `sorted_children`, unless they're already in that
+    order.  Elements compare by identity, so the check is a cheap pass over two lists, while putting the children
+    back means detaching and reattaching every one of them in lxml."""
+    if sorted_children != children:
+        par[:] = sorted_children
 
 
 def sort_xml(xml_doc, node_path, sort_attr, use_text=False, sort_as_datetime=False, sort_as_decimal=False,
-             descending=False):
+             descending=False, cache=None):
     """Sort the children of a selection of elements in an XML document. Returns an ElementTree representing the
-    resulting whole document. ElementTree can easily be converted to string or written to a file like so:
+    resulting whole document (an `lxml.etree` ElementTree if lxml is installed). ElementTree can easily be written to a
+    file like so:
     
-    >>> foo_str = ET.tostring(sort_xml(xml_doc, node_path, sort_attr).getroot())
     >>> sort_xml(xml_doc, node_path, sort_attr).write('foo.xml')
+    
+    To convert it to a string instead, use `tostring()` from `lxml.etree` if lxml is installed, or from
+    `xml.etree.ElementTree` if it isn't.
 
     Required arguments:
     -------------------
@@ -155,11 +206,15 @@ def sort_xml(xml_doc, node_path, sort_attr, use_text=False, sort_as_datetime=Fal
     * `sort_as_decimal` -- try to parse the values of the sort key as a decimal and sort numerically (useful to keep
       '10' from showing up right after '1') (default: False, mutually exclusive with `sort_as_datetime`)
     * `descending` -- sort in descending order instead of ascending (default: False)
+    * `cache` -- a dict to keep parsed documents in, so later calls passing the same dict can sort the same document
+      again without parsing it again.  Entries are kept until the dict is cleared or discarded.  (default: None,
+      nothing is kept)
     
     """
     # check parameters
 
     # xml_doc
+    xml_str = xml_file = None
     if isinstance(xml_doc, TextIOWrapper) and xml_doc.readable():
         # xml_doc is a readable text stream, let's read it
         # but first make sure to remove any byte order marker
@@ -170,14 +225,15 @@ def sort_xml(xml_doc, node_path, sort_attr, use_text=False, sort_as_datetime=Fal
         xml_str = xml_doc.read()
     elif isinstance(xml_doc, Path) and xml_doc.is_file():
         # xml_doc is a Path object to a file
-        xml_str = xml_doc.read_text('utf-8-sig')  # utf-8-sig to remove byte order marker
+        # the parser will stream it from disk and decode it itself, skipping any byte order marker
+        xml_file = str(xml_doc)
     elif isinstance(xml_doc, str) and Path(xml_doc).is_file():
         # xml_doc is a filename
-        xml_str = Path(xml_doc).read_text('utf-8-sig')
+        xml_file = xml_doc
     elif isinstance(xml_doc, str) and len(xml_doc) > 0:
         # xml_doc hopefully contains valid XML
         if xml_doc.startswith(BOM_UTF8.decode('utf-8')):
-            xml_str = xml_doc[3:]
+            xml_str = xml_doc[1:]  # the byte order marker is a single character once decoded
         else:
             xml_str = xml_doc
     else:
@@ -190,32 +246,90 @@ def sort_xml(xml_doc, node_path, sort_attr, use_text=False, sort_as_datetime=Fal
                         f"sort_attr: {repr(sort_attr)}")
     else:
         sort_attr = sort_attr.strip()
-    if not (sort_attr.replace('_', '').isalnum() and (sort_attr[0].isalpha() or sort_attr[0] == '_')):
+    if not _NAME_RE.match(sort_attr):
         raise ValueError("Sort attribute passed to sort_xml() is an invalid name!\n\t"
                          f"sort_attr: {repr(sort_attr)}")
     
-    # make our element tree using our custom treebuilder and get all the parents we have to sort children of
+    # make our element tree and get all the parents we have to sort children of
+
+    if cache is not None:
+        dom, ns_map = _parse_xml_cached(xml_file, xml_str, cache)
+    else:
+        dom, ns_map = _parse_xml(xml_file, xml_str)
+    if etree is None:
+        # ElementTree picks output prefixes from a global registry, so register this document's prefixes (once each,
+        # rather than every time the document redeclares them).  Done here so it also happens on a cache hit, in case
+        # another document has rebound a prefix since.
+        for prefix, uri in ns_map.items():
+            ET.register_namespace(prefix, uri)
 
-    dom = ET.fromstring(xml_str, ET.XMLParser(target=NSTreeBuilder()))
-    matching_parents = dom.findall(node_path)
+    # find every match before sorting any of them: sorting a parent while still walking the tree could change which
+    # elements later parts of the path (like positional predicates) match, and lxml's iterators would skip nodes
+    matching_parents = dom.findall(node_path, namespaces=ns_map)
     
-    # check what kind of sorting we're doing and do it
-    # TODO might be faster if we do the check once and then run the appropriate for loop?
+    # work out what kind of sorting we're doing once, then sort every parent the same way.  The sort key values
+    # are pulled out with a list comprehension, which avoids a Python-level function call per child.
+    if use_text:
+        # sort_attr is a plain name, so it's in the default namespace if the document has one.  Qualifying it once
+        # up front means the subelement path doesn't need to be resolved against ns_map for every child.
+        default_ns = ns_map.get(None if etree is not None else '')
+        sub_tag = f'{{{default_ns}}}{sort_attr}' if default_ns else sort_attr
+        if etree is not None:
+            find_sub = _compiled_xpath(sub_tag)
+
+            def get_values(children):
+                return [(found[0].text or '') if found else None for found in map(find_sub, children)]
+        else:
+            def get_values(children):
+                return [x.findtext(sub_tag) for x in children]
+    else:
+        def get_values(children):
+            return [x.get(sort_attr) for x in children]
+
+    use_numpy = False
+    if sort_as_decimal:
+        # numpy is optional and only used to sort decimal keys, so only pay for importing it when we're doing that
+        try:
+            import numpy  # noqa: F401
+            use_numpy = True
+        except ImportError:
+            pass
+
+    if sort_as_datetime:
+        parse_key = _parse_datetime
+    elif sort_as_decimal:
+        parse_key = Decimal
+    else:
+        parse_key = None
+
     for par in matching_parents:
-        if use_text:
-            if sort_as_datetime:
-                par[:] = sorted(par, key=lambda x: parse_dt(x.findtext(sort_attr)), reverse=descending)
-            elif sort_as_decimal:
-                par[:] = sorted(par, key=lambda x: Decimal(x.findtext(sort_attr)), reverse=descending)
+        # pull the sort keys out into their own list in a single pass, sort the indices of that list, then put the
+        # children in that order, so the elements themselves never take part in a comparison.  The children are only
+        # fetched from the tree once, since lxml allocates a new proxy object for an element every time it's fetched
+        # while none is alive.
+        children = list(par)
+        values = get_values(children)
+        order = None
+        if use_numpy:
+            # try sorting the keys as an array of floats first, which avoids comparing Decimal objects entirely
+            order = _argsort_decimal(values, descending)
+        if order is None:
+            if parse_key is not None:
+                # children often share values, in which case it's worth only parsing each distinct one once.  Building
+                # the memo costs more than it saves when most values are unique, so check a sample first.
+                sample = values[:1024]
+                if len(set(sample)) <= len(sample) // 2:
+                    parsed = {v: parse_key(v) for v in set(values)}
+                    keys = list(map(parsed.__getitem__, values))
+                else:
+                    keys = list(map(parse_key, values))
             else:
-                par[:] = sorted(par, key=lambda x: x.findtext(sort_attr), reverse=descending)
-        elif sort_as_datetime:
-            par[:] = sorted(par, key=lambda x: parse_dt(x.get(sort_attr)), reverse=descending)
-        elif sort_as_decimal:
-            par[:] = sorted(par, key=lambda x: Decimal(x.get(sort_attr)), reverse=descending)
-        else:
-            par[:] = sorted(par, key=lambda x: x.get(sort_attr), reverse=descending)
+                keys = values
+            order = sorted(range(len(keys)), key=keys.__getitem__, reverse=descending)
+        _reorder(par, children, [children[i] for i in order])
             
+    if etree is not None:
+        return etree.ElementTree(dom)
     return ET.ElementTree(dom)
 
 
@@ -251,12 +365,14 @@ if __name__ == '__main__':
     
     sorted_xml = sort_xml(xml_doc, sort_path, sort_attr, use_text, as_dt, as_dec, sort_desc)
     
-    if not hasattr(argv, 'output_file'):
+    if argv.output_file is None:
         new_filename = xml_doc.stem + '_sorted'
         out_file = xml_doc.with_stem(new_filename)
     else:
         out_file = argv.output_file
     
-    out_file.write_text(ET.tostring(sorted_xml.getroot(), encoding='unicode'), encoding='utf-8')
+    # write straight to the file instead of building the whole document as a string first.  Passing the filename
+    # rather than a file object lets lxml's C serializer do the file I/O itself too.
+    sorted_xml.write(str(out_file), encoding='utf-8', xml_declaration=True)
         
     print(f"Output sorted file as `{out_file}`")
@@ -0,0 +1,255 @@
+"""Tests for sortxml.  Run with `python -m unittest` (or pytest) from the project directory."""
+
+import os
+import random
+import runpy
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from contextlib import redirect_stdout
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+
+from dateutil.parser import parse as parse_dt
+
+import sortxml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def decimal_order(values, descending=False):
+    """The order sorting `values` by Decimal would put them in, which the fast paths have to match exactly."""
+    return sorted(range(len(values)), key=lambda i: Decimal(values[i]), reverse=descending)
+
+
+def sorted_keys(xml_str, sort_attr='k', **kwargs):
+    """Sort the children of the `p` element and return their `k` attributes in their new order."""
+    return [c.get('k') for c in sortxml.sort_xml(xml_str, 'p', sort_attr, **kwargs).getroot()[0]]
+
+
+def tostring(tree):
+    """Serialize a tree returned by `sort_xml` with whichever backend made it."""
+    out = BytesIO()
+    tree.write(out)
+    return out.getvalue()
+
+
+def children(*keys):
+    return '<r><p>' + ''.join(f'<c k="{k}" i="{i}"/>' for i, k in enumerate(keys)) + '</p></r>'
+
+
+@unittest.skipIf(numpy is None, "numpy isn't installed")
+class ArgsortDecimalTest(unittest.TestCase):
+
+    def test_matches_decimal_order(self):
+        rng = random.Random(1)
+        values = [str(rng.randint(-10 ** 6, 10 ** 6) / 8) for _ in range(2000)] + ['Infinity', '-inf', '1e300']
+        for descending in (False, True):
+            self.assertEqual(sortxml._argsort_decimal(values, descending), decimal_order(values, descending))
+
+    def test_equal_keys_keep_document_order(self):
+        values = ['1', '2', '1', '2', '1']
+        self.assertEqual(sortxml._argsort_decimal(values), [0, 2, 4, 1, 3])
+        self.assertEqual(sortxml._argsort_decimal(values, descending=True), [1, 3, 0, 2, 4])
+
+    def test_distinct_decimals_rounding_to_same_float(self):
+        self.assertIsNone(sortxml._argsort_decimal(['0.1000000000000000001', '0.1']))
+
+    def test_overflow_to_infinity(self):
+        self.assertIsNone(sortxml._argsort_decimal(['1e401', '1e400']))
+
+    def test_signed_zeros(self):
+        # equal as floats but spelled differently, so we can't trust the float sort
+        self.assertIsNone(sortxml._argsort_decimal(['0', '-0']))
+
+    def test_unparseable(self):
+        self.assertIsNone(sortxml._argsort_decimal(['NaN', '1']))
+        self.assertIsNone(sortxml._argsort_decimal(['abc', '1']))
+        self.assertIsNone(sortxml._argsort_decimal([None, '1']))
+
+
+class BackendTestMixin:
+    """Tests that have to give the same result with either parser backend."""
+
+    def test_decimal_sort_with_fallbacks(self):
+        for keys in (['10', '9', '1', '9.0', '2'],
+                     ['0.1000000000000000001', '0.1', '1e400', '1e401'],
+                     ['0', '-0', '-1']):
+            for descending in (False, True):
+                expected = [keys[i] for i in decimal_order(keys, descending)]
+                self.assertEqual(sorted_keys(children(*keys), sort_as_decimal=True, descending=descending), expected)
+
+    def test_datetime_sort(self):
+        iso = ['2021-03-01', '2020-12-31T10:00:00', '2021-01-02 08:30']
+        other = ['Jan 3 2020', 'Feb 1 2019', '5 March 2020']
+        for keys in (iso, other, iso + other):
+            for descending in (False, True):
+                expected = sorted(keys, key=parse_dt, reverse=descending)
+                self.assertEqual(sorted_keys(children(*keys), sort_as_datetime=True, descending=descending), expected)
+
+    def test_iso_datetimes_skip_dateutil(self):
+        with mock.patch.object(sortxml, 'parse_dt', wraps=parse_dt) as dateutil_parse:
+            sorted_keys(children('2021-03-01', 'Jan 3 2020', '2020-12-31T10:00:00'), sort_as_datetime=True)
+        dateutil_parse.assert_called_once_with('Jan 3 2020')
+
+    def test_repeated_keys_are_parsed_once(self):
+        dates = ['2021-03-01', 'Jan 3 2020', '2021-03-01', 'Jan 3 2020', '2021-03-01', '2020-12-31']
+        with mock.patch.object(sortxml, '_parse_datetime', wraps=sortxml._parse_datetime) as parse:
+            self.assertEqual(sorted_keys(children(*dates), sort_as_datetime=True),
+                             sorted(dates, key=parse_dt))
+        self.assertEqual(parse.call_count, 3)
+
+        # keep the NumPy fast path out of the way so the Decimal path runs
+        numbers = ['10', '2', '10', '2.0', '10', '2']
+        with mock.patch.dict(sys.modules, {'numpy': None}), \
+                mock.patch.object(sortxml, 'Decimal', wraps=Decimal) as parse:
+            self.assertEqual(sorted_keys(children(*numbers), sort_as_decimal=True),
+                             [numbers[i] for i in decimal_order(numbers)])
+        self.assertEqual(parse.call_count, 3)
+
+    def test_mostly_unique_keys_are_parsed_directly(self):
+        dates = ['2021-03-01', 'Jan 3 2020', '2020-12-31', '2021-03-01']
+        with mock.patch.object(sortxml, '_parse_datetime', wraps=sortxml._parse_datetime) as parse:
+            self.assertEqual(sorted_keys(children(*dates), sort_as_datetime=True), sorted(dates, key=parse_dt))
+        self.assertEqual(parse.call_count, 4)
+
+    def test_sort_attr_names(self):
+        for name in ('_', 'é1', '名前'):
+            xml_str = f'<r><p><c {name}="b" k="b"/><c {name}="a" k="a"/></p></r>'
+            self.assertEqual(sorted_keys(xml_str, name), ['a', 'b'])
+        for name in ('   ', '1a', 'a-b'):
+            with self.assertRaises(ValueError):
+                sortxml.sort_xml(children('b', 'a'), 'p', name)
+
+    def test_descending_sort_is_stable(self):
+        xml_str = children('a', 'b', 'a', 'b')
+        result = sortxml.sort_xml(xml_str, 'p', 'k', descending=True).getroot()[0]
+        self.assertEqual([c.get('i') for c in result], ['1', '3', '0', '2'])
+
+    def test_comments_and_processing_instructions(self):
+        xml_str = '<r><p><!-- note --><?pi x?><c k="b"><t>2</t></c><c k="a"><t>1</t></c></p></r>'
+        self.assertEqual(sorted_keys(xml_str), ['a', 'b'])
+        self.assertEqual(sorted_keys(xml_str, 't', use_text=True), ['a', 'b'])
+        self.assertEqual(sorted_keys(xml_str, 't', use_text=True, sort_as_decimal=True), ['a', 'b'])
+
+    def test_sort_by_subelement_text_in_default_namespace(self):
+        xml_str = '<r xmlns="urn:x"><p><c k="b"><t>2</t></c><c k="a"><t>10</t></c></p></r>'
+        self.assertEqual(sorted_keys(xml_str, 't', use_text=True, sort_as_decimal=True), ['b', 'a'])
+
+    def test_entities_in_sort_key(self):
+        xml_str = '<!DOCTYPE r [<!ENTITY e "Z">]><r><p><c k="z"><t>&e;</t></c><c k="a"><t>A</t></c></p></r>'
+        self.assertEqual(sorted_keys(xml_str, 't', use_text=True), ['a', 'z'])
+
+    def test_external_entities_are_not_loaded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            secret = os.path.join(tmp, 'secret.txt')
+            with open(secret, 'w') as f:
+                f.write('secret')
+            xml_str = (f'<!DOCTYPE r [<!ENTITY e SYSTEM "{Path(secret).as_uri()}">]>'
+                       '<r><p><c k="z"><t>&e;</t></c><c k="a"><t>A</t></c></p></r>')
+            with self.assertRaises(SyntaxError):
+                sortxml.sort_xml(xml_str, 'p', 't', use_text=True)
+
+    def test_positional_predicate_matches_document_order(self):
+        xml_str = '<r><p k="0"><p k="b"><x k="2"/><x k="1"/></p><p k="a"><x k="4"/><x k="3"/></p></p></r>'
+        root = sortxml.sort_xml(xml_str, './/p[1]', 'k').getroot()
+        self.assertEqual([p.get('k') for p in root[0]], ['a', 'b'])
+        self.assertEqual([x.get('k') for x in root[0][1]], ['1', '2'])
+        self.assertEqual([x.get('k') for x in root[0][0]], ['4', '3'])
+
+    def test_cache_reuses_parsed_document(self):
+        cache = {}
+        xml_str = children('b', 'c', 'a')
+        with mock.patch.object(sortxml, '_parse_xml', wraps=sortxml._parse_xml) as parse:
+            self.assertEqual(sorted_keys(xml_str, cache=cache), ['a', 'b', 'c'])
+            # the cached tree must not have been sorted along with the first result
+            self.assertEqual(sorted_keys(xml_str, cache=cache, descending=True), ['c', 'b', 'a'])
+            self.assertEqual(sorted_keys(xml_str, 'i', cache=cache), ['b', 'c', 'a'])
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_cache_hit_keeps_namespace_prefixes(self):
+        cache = {}
+        first = '<r xmlns:x="urn:A"><x:p><x:c k="b"/><x:c k="a"/></x:p></r>'
+        second = '<r xmlns:x="urn:B"><x:p><x:c k="b"/><x:c k="a"/></x:p></r>'
+        expected = tostring(sortxml.sort_xml(first, 'x:p', 'k'))
+        sortxml.sort_xml(first, 'x:p', 'k', cache=cache)
+        sortxml.sort_xml(second, 'x:p', 'k', cache=cache)
+        self.assertEqual(tostring(sortxml.sort_xml(first, 'x:p', 'k', cache=cache)), expected)
+        self.assertIn(b'xmlns:x="urn:A"', expected)
+
+    def test_cache_sees_rewritten_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'doc.xml')
+            cache = {}
+            with open(path, 'w') as f:
+                f.write(children('b', 'a'))
+            self.assertEqual(sorted_keys(path, cache=cache), ['a', 'b'])
+            # same size and, on filesystems with coarse timestamps, possibly the same mtime
+            stat = os.stat(path)
+            with open(path, 'w') as f:
+                f.write(children('d', 'c'))
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(sorted_keys(path, cache=cache), ['c', 'd'])
+        self.assertEqual(len(cache), 2)
+
+    def test_no_cache_by_default(self):
+        with mock.patch.object(sortxml, '_parse_xml', wraps=sortxml._parse_xml) as parse:
+            sorted_keys(children('b', 'a'))
+            sorted_keys(children('b', 'a'))
+        self.assertEqual(parse.call_count, 2)
+
+
+@unittest.skipIf(sortxml.etree is None, "lxml isn't installed")
+class LxmlBackendTest(BackendTestMixin, unittest.TestCase):
+    pass
+
+
+class ElementTreeBackendTest(BackendTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(sortxml, 'etree', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CommandLineTest(unittest.TestCase):
+    fields = "./DataSets/DataSet[@Name='ARForm']/Fields"
+
+    def run_cli(self, hide_lxml=False):
+        """Run sortxml.py as a script on a copy of example.xml and return the parsed output file."""
+        with tempfile.TemporaryDirectory() as tmp:
+            src = Path(tmp, 'example.xml')
+            src.write_bytes(Path(__file__).with_name('example.xml').read_bytes())
+            argv = ['sortxml.py', str(src), self.fields, 'Name']
+            modules = {'lxml': None} if hide_lxml else {}
+            with mock.patch.object(sys, 'argv', argv), mock.patch.dict(sys.modules, modules), \
+                    redirect_stdout(StringIO()):
+                script = runpy.run_path(sortxml.__file__, run_name='__main__')
+            self.assertEqual(script['etree'] is None, hide_lxml)
+            out = Path(tmp, 'example_sorted.xml')
+            self.assertTrue(out.read_bytes().startswith(b"<?xml version='1.0' encoding='"))
+            return ET.parse(out)
+
+    def check_sorted(self, tree):
+        ns = {'': 'http://schemas.microsoft.com/sqlserver/reporting/2016/01/reportdefinition'}
+        names = [f.get('Name') for f in tree.getroot().find(self.fields, ns)]
+        self.assertTrue(names)
+        self.assertEqual(names, sorted(names))
+
+    @unittest.skipIf(sortxml.etree is None, "lxml isn't installed")
+    def test_lxml(self):
+        self.check_sorted(self.run_cli())
+
+    def test_elementtree(self):
+        self.check_sorted(self.run_cli(hide_lxml=True))
+
+
+if __name__ == '__main__':
+    unittest.main()